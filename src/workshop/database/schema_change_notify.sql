@@ -0,0 +1,19 @@
+-- Optional: notify listening agents when DDL changes the database schema so they
+-- refresh their cached schema description (see SalesData in sales_data.py).
+-- Event triggers must be created by a superuser or, on Azure Database for
+-- PostgreSQL, a member of azure_pg_admin.
+
+CREATE OR REPLACE FUNCTION contoso.notify_schema_changed()
+RETURNS event_trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('schema_changed', tg_tag);
+END;
+$$;
+
+DROP EVENT TRIGGER IF EXISTS contoso_schema_changed;
+
+CREATE EVENT TRIGGER contoso_schema_changed
+    ON ddl_command_end
+    EXECUTE FUNCTION contoso.notify_schema_changed();
@@ -1,6 +1,8 @@
 import asyncio
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 from azure.ai.projects.aio import AIProjectClient
 from azure.ai.projects.models import (
@@ -47,6 +49,7 @@ project_client = AIProjectClient.from_connection_string(
 functions = AsyncFunctionTool(
     {
         sales_data.async_fetch_sales_data,
+        sales_data.fetch_many,
     }
 )
 
@@ -177,7 +180,27 @@ async def main() -> None:
         print("The agent resources have been cleaned up.")
 
 
+def setup_logging() -> QueueListener:
+    """Route log records through a queue so emitting them never blocks the event loop."""
+    root = logging.getLogger()
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
 if __name__ == "__main__":
     print("Starting async program...")
-    asyncio.run(main())
+    log_listener = setup_logging()
+    try:
+        try:
+            # uvloop is faster than the default event loop for asyncpg-heavy workloads, but is not available on Windows
+            import uvloop
+        except ImportError:
+            asyncio.run(main())
+        else:
+            uvloop.run(main())
+    finally:
+        log_listener.stop()
     print("Program finished.")
@@ -1,109 +1,268 @@
-import json
+import asyncio
 import logging
 import os
-from typing import Optional, List, Dict
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Optional, List, Dict, Tuple
 import asyncpg
-import pandas as pd
+import orjson
 from terminal_colors import TerminalColors as tc
 
 POSTGRES_CONNECTION_STRING = os.getenv("POSTGRES_CONNECTION_STRING")
 DB_SCHEMA = "contoso"
+DB_INFO_CACHE_TTL = float(os.getenv("DB_INFO_CACHE_TTL", "300"))
+# Channel notified by the database/schema_change_notify.sql event trigger whenever DDL runs
+SCHEMA_CHANGED_CHANNEL = "schema_changed"
+POOL_MIN = int(os.getenv("POOL_MIN", "2"))
+POOL_MAX = int(os.getenv("POOL_MAX", "10"))
+POOL_IDLE_SEC = float(os.getenv("POOL_IDLE_SEC", "300"))
+# Client-side bound on any single query so a runaway LLM-generated query can't hold a connection indefinitely
+QUERY_TIMEOUT_SEC = float(os.getenv("QUERY_TIMEOUT_SEC", "30"))
+# Server-side limits applied to every pooled connection
+STATEMENT_TIMEOUT = os.getenv("STATEMENT_TIMEOUT", "15s")
+IDLE_IN_TRANSACTION_TIMEOUT = os.getenv("IDLE_IN_TRANSACTION_TIMEOUT", "30s")
+# asyncpg caches the statements run through conn.fetch per connection, which covers the database info queries.
+# Agent queries use conn.prepare() for their column metadata, which bypasses this cache; repeats of those are
+# served by the query result cache instead.
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "1024"))
+# Upper bound on queries from one fetch_many call running at once
+MAX_CONCURRENT_QUERIES = int(os.getenv("MAX_CONCURRENT_QUERIES", "8"))
+# LRU cache of query results keyed by the query text; the workshop data is static so entries expire on TTL only
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+# Rows fetched per round-trip when streaming query results
+CURSOR_PREFETCH = 10_000
+
+# One pre-formatted row per table, so the column list is assembled by the database
+SCHEMA_QUERY = """
+    SELECT table_name, string_agg(column_name || ': ' || data_type, ', ' ORDER BY ordinal_position) AS columns
+    FROM information_schema.columns
+    WHERE table_schema = $1
+    GROUP BY table_name
+    ORDER BY table_name;
+"""
+
+# Important fields and their sales_data columns
+FIELD_COLUMNS = {
+    "Regions": "region",
+    "Product Types": "product_type",
+    "Product Categories": "main_category",
+    "Reporting Years": "year",
+}
+
+# The field lookups fused into one round-trip returning (field, value) rows. Built once so the
+# SQL text is identical on every call and hits the connection's prepared statement cache.
+FIELD_VALUES_QUERY = (
+    " UNION ALL ".join(
+        f"SELECT DISTINCT '{field}' AS field, {column}::text AS value FROM {DB_SCHEMA}.sales_data" for field, column in FIELD_COLUMNS.items()
+    )
+    + " ORDER BY field, value;"
+)
+
+_QUERY_LOG_PREFIX = f"\n{tc.BLUE}Executing query: "
+_QUERY_LOG_SUFFIX = f"{tc.RESET}\n"
+# Queries must start with SELECT or WITH, after any whitespace, opening parentheses and -- or /* */ comments.
+# This is only a cheap pre-check; the read-only transaction is what actually prevents writes.
+_SELECT_RE = re.compile(r"(?:\s|\(|--[^\n]*(?:\n|\Z)|/\*(?:[^*]|\*(?!/))*\*/)*(SELECT|WITH)\b", re.IGNORECASE)
+NO_RESULTS_MESSAGE = orjson.dumps("The query returned no results. Try a different question.").decode()
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
 
+def _dumps(obj: object) -> str:
+    """Serialize obj to a JSON string, falling back to str for types orjson does not support."""
+    return orjson.dumps(obj, default=str).decode()
+
+
 class SalesData:
     def __init__(self) -> None:
         self.pool: Optional[asyncpg.Pool] = None
+        self._db_info_cache: Optional[str] = None
+        self._db_info_expiry: float = 0.0
+        self._schema_listener: Optional[asyncpg.Connection] = None
+        self._schema_prologue: Optional[str] = None
+        # Bumped on every schema change so a fetch that raced a notification does not cache stale results
+        self._schema_generation: int = 0
+        self._query_cache: OrderedDict[str, Tuple[float, str]] = OrderedDict()
 
     async def connect(self) -> None:
         """Establish a connection pool to the database."""
         try:
-            self.pool = await asyncpg.create_pool(dsn=POSTGRES_CONNECTION_STRING)
+            self.pool = await asyncpg.create_pool(
+                dsn=POSTGRES_CONNECTION_STRING,
+                init=self._init_connection,
+                min_size=POOL_MIN,
+                max_size=POOL_MAX,
+                max_inactive_connection_lifetime=POOL_IDLE_SEC,
+                command_timeout=QUERY_TIMEOUT_SEC,
+                statement_cache_size=STATEMENT_CACHE_SIZE,
+                # Sent as startup parameters so they also survive the RESET ALL the pool issues on release
+                server_settings={
+                    "statement_timeout": STATEMENT_TIMEOUT,
+                    "idle_in_transaction_session_timeout": IDLE_IN_TRANSACTION_TIMEOUT,
+                },
+            )
             logger.info("Database connection pool created.")
         except Exception as e:
             logger.exception("Failed to connect to the database", exc_info=e)
             raise
 
+        # A dedicated connection, as the pool resets connections (including UNLISTEN) on release
+        try:
+            self._schema_listener = await asyncpg.connect(dsn=POSTGRES_CONNECTION_STRING)
+            await self._schema_listener.add_listener(SCHEMA_CHANGED_CHANNEL, self._on_schema_changed)
+            self._schema_listener.add_termination_listener(self._on_schema_listener_lost)
+        except Exception as e:
+            logger.warning(f"Schema change listener unavailable, schema will not be cached: {e}")
+            if self._schema_listener:
+                await self._schema_listener.close()
+            self._schema_listener = None
+
+    async def _init_connection(self, conn: asyncpg.Connection) -> None:
+        """Decode numeric and uuid in the protocol layer so results serialize without a conversion pass."""
+        await conn.set_type_codec("numeric", encoder=str, decoder=float, schema="pg_catalog", format="text")
+        await conn.set_type_codec("uuid", encoder=str, decoder=str, schema="pg_catalog", format="text")
+
+    def _on_schema_changed(self, _conn: asyncpg.Connection, _pid: int, _channel: str, payload: str) -> None:
+        """Drop the cached schema when the database reports a DDL change."""
+        logger.info(f"Schema change notification received: {payload}")
+        self._schema_generation += 1
+        self._schema_prologue = None
+        self.invalidate_db_info()
+
+    def _on_schema_listener_lost(self, _conn: asyncpg.Connection) -> None:
+        """Stop caching the schema once notifications can no longer be received."""
+        self._schema_listener = None
+        self._schema_generation += 1
+        self._schema_prologue = None
+
     async def close(self) -> None:
         """Close the database connection pool."""
+        if self._schema_listener:
+            await self._schema_listener.close()
+            self._schema_listener = None
+            self._schema_prologue = None
         if self.pool:
             await self.pool.close()
             self.pool = None
             logger.info("Database connection pool closed.")
 
-    async def fetch_list(self, query: str, column: str) -> List[str]:
-        """Fetch a list of values from the database."""
-        if not self.pool:
-            logger.warning("Database connection is not established.")
-            return []
-
-        try:
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(query)
-                return [row[column] for row in rows]
-        except Exception as e:
-            logger.error(f"Failed to execute query: {query} | Error: {e}")
-            return []
+    def invalidate_db_info(self) -> None:
+        """Discard the cached database info so the next call queries the database."""
+        self._db_info_cache = None
+        self._db_info_expiry = 0.0
 
     async def get_database_info(self) -> str:
         """Retrieve database schema and common query fields."""
         if not self.pool:
             return "Database connection is not established."
 
-        schema_query = """
-            SELECT table_name, column_name, data_type
-            FROM information_schema.columns
-            WHERE table_schema = $1
-            ORDER BY table_name, ordinal_position;
-        """
+        if self._db_info_cache is not None and time.monotonic() < self._db_info_expiry:
+            return self._db_info_cache
 
+        # Run both queries on one connection rather than acquiring from the pool per query.
+        # The schema is only re-read after a change notification, or when there is no listener to send one.
+        schema_data = None
+        generation = self._schema_generation
+        schema_prologue = self._schema_prologue
         try:
             async with self.pool.acquire() as conn:
-                schema_data = await conn.fetch(schema_query, DB_SCHEMA)
+                if schema_prologue is None:
+                    schema_data = await conn.fetch(SCHEMA_QUERY, DB_SCHEMA)
+                field_data = await conn.fetch(FIELD_VALUES_QUERY)
         except Exception as e:
-            logger.error(f"Schema query failed: {e}")
+            logger.error(f"Database info query failed: {e}")
             return "Error fetching schema information."
 
-        tables: Dict[str, List[str]] = {}
-        for row in schema_data:
-            tables.setdefault(row["table_name"], []).append(f"{row['column_name']}: {row['data_type']}")
+        # A notification that arrived during the fetch means these results may predate the change
+        schema_unchanged = generation == self._schema_generation
 
-        database_info = [
-            f"Table {DB_SCHEMA}.{table}: Columns: {', '.join(cols)}"
-            for table, cols in tables.items()
-        ]
+        # The schema prologue is formatted once and reused until the schema changes
+        if schema_data is not None:
+            schema_prologue = "\n".join(f"Table {DB_SCHEMA}.{row['table_name']}: Columns: {row['columns']}" for row in schema_data)
+            if self._schema_listener and schema_unchanged:
+                self._schema_prologue = schema_prologue
 
-        # Important fields and their queries
-        field_queries = {
-            "Regions": "SELECT DISTINCT region FROM contoso.sales_data;",
-            "Product Types": "SELECT DISTINCT product_type FROM contoso.sales_data;",
-            "Product Categories": "SELECT DISTINCT main_category FROM contoso.sales_data;",
-            "Reporting Years": "SELECT DISTINCT year FROM contoso.sales_data ORDER BY year;",
-        }
+        fields: Dict[str, List[str]] = {field: [] for field in FIELD_COLUMNS}
+        for row in field_data:
+            fields[row["field"]].append(row["value"])
 
-        for field, query in field_queries.items():
-            values = await self.fetch_list(query, query.split()[2])
-            database_info.append(f"{field}: {', '.join(map(str, values))}")
+        fields_section = "\n".join(f"{field}: {', '.join(map(str, values))}" for field, values in fields.items())
 
-        return "\n".join(database_info)
+        database_info = f"{schema_prologue}\n{fields_section}" if schema_prologue else fields_section
+        if schema_unchanged:
+            self._db_info_cache = database_info
+            self._db_info_expiry = time.monotonic() + DB_INFO_CACHE_TTL
+        return database_info
 
     async def async_fetch_sales_data(self, query: str) -> str:
         """Execute a query and return the result as a JSON string."""
         if not self.pool:
-            return json.dumps({"error": "Database connection is not established."})
+            return _dumps({"error": "Database connection is not established."})
 
-        print((f"\n{tc.BLUE}Executing query: {query}{tc.RESET}\n"))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s%s%s", _QUERY_LOG_PREFIX, query, _QUERY_LOG_SUFFIX)
 
-        try:
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(query)
-                if not rows:
-                    return json.dumps("The query returned no results. Try a different question.")
+        # Reject anything that isn't a read before spending a round-trip on it
+        if not _SELECT_RE.match(query):
+            return _dumps({"error": "Only SELECT queries are allowed.", "query": query})
 
-                df = pd.DataFrame(rows, columns=rows[0].keys())
-                return df.to_json(index=False, orient="split")
+        cached = self._query_cache.get(query)
+        if cached is not None:
+            expiry, result = cached
+            if time.monotonic() < expiry:
+                self._query_cache.move_to_end(query)
+                return result
+            del self._query_cache[query]
+
+        try:
+            result = await self._execute_query(query)
         except Exception as e:
             logger.error(f"Query execution failed: {e}")
-            return json.dumps({"error": str(e), "query": query})
\ No newline at end of file
+            return _dumps({"error": str(e), "query": query})
+
+        self._query_cache[query] = (time.monotonic() + QUERY_CACHE_TTL, result)
+        if len(self._query_cache) > QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+        return result
+
+    async def _execute_query(self, query: str) -> str:
+        """Run a query and serialize its result as column-oriented JSON."""
+        async with self.pool.acquire() as conn:
+            # prepare() is not served from the statement cache, so this always sends a Parse; it is
+            # used to get the result column names and types, even when there are no rows
+            stmt = await conn.prepare(query)
+            attributes = stmt.get_attributes()
+            columns: List[List[Any]] = [[] for _ in attributes]
+
+            # Stream rows in batches straight into the column lists instead of buffering every record.
+            # The read-only transaction makes the server reject any write that slips past _SELECT_RE.
+            async with conn.transaction(readonly=True, isolation="repeatable_read"):
+                async for row in stmt.cursor(prefetch=CURSOR_PREFETCH):
+                    for column, value in zip(columns, row, strict=True):
+                        column.append(value)
+
+            if not columns or not columns[0]:
+                return NO_RESULTS_MESSAGE
+
+            # Column-oriented layout: each column name appears once rather than per row. The value lists
+            # line up with schema by position, as result column names can repeat (e.g. two SUM() columns).
+            payload = {
+                "schema": [{"name": attr.name, "type": attr.type.name} for attr in attributes],
+                "columns": columns,
+            }
+            return _dumps(payload)
+
+    async def fetch_many(self, queries: List[str]) -> str:
+        """Execute several independent queries concurrently and return their results as a JSON array, in query order."""
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+        async def fetch_one(query: str) -> str:
+            async with semaphore:
+                return await self.async_fetch_sales_data(query)
+
+        results = await asyncio.gather(*(fetch_one(query) for query in queries))
+        # Each result is already a JSON document, so join them rather than decoding and re-encoding
+        return f"[{','.join(results)}]"
\ No newline at end of file